@@ -1,13 +1,21 @@
 # server.py
 import os
-import json
-import base64
+import re
+import binascii
+import struct
+import hashlib
+import tempfile
 import asyncio
 import logging
-import requests
+from collections import deque
+from pathlib import Path
+import httpx
+import numpy as np
+import orjson
 import websockets
 from dotenv import load_dotenv
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
 import uvicorn
 
 # ================= ENV =================
@@ -18,8 +26,25 @@ SARVAM_API_KEY = os.getenv("SARVAM_API_KEY")
 
 # ================= CONFIG =================
 SAMPLE_RATE = 16000
+# Halve the caller audio before STT to cut upload size; Deepgram handles 8 kHz fine
+STT_DOWNSAMPLE = os.getenv("STT_DOWNSAMPLE") == "1"
+STT_SAMPLE_RATE = SAMPLE_RATE // 2 if STT_DOWNSAMPLE else SAMPLE_RATE
 MIN_CHUNK_SIZE = 3200
+MAX_CHUNK_SIZE = 100000
+CHUNK_ALIGN = 320
+# Exotel takes media chunks of 3.2k-100k bytes in multiples of 320;
+# bigger chunks mean fewer frames and sends per reply
+MEDIA_CHUNK_SIZE = min(max(int(os.getenv("MEDIA_CHUNK_SIZE", 16000)), MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+MEDIA_CHUNK_SIZE -= MEDIA_CHUNK_SIZE % CHUNK_ALIGN
 POST_TTS_DELAY = 0.6
+DG_POOL_SIZE = int(os.getenv("DG_POOL_SIZE", 2))
+DG_KEEPALIVE_INTERVAL = 5
+DG_MAX_SOCKET_AGE = 15 * 60
+DG_FINALIZE_TIMEOUT = 1.5
+OUT_QUEUE_SIZE = 64
+IN_QUEUE_SIZE = 50
+TTS_LANGUAGE = "en-IN"
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", "tts_cache"))
 
 # ================= LOGGING =================
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(message)s")
@@ -27,6 +52,25 @@ log = logging.getLogger("voicebot")
 
 app = FastAPI()
 
+# ================= HTTP =================
+# One pooled client for all calls so Sarvam requests reuse the TLS session
+CLIENT = httpx.AsyncClient(
+    base_url="https://api.sarvam.ai",
+    # httpx rejects None header values, and a missing key shouldn't stop the app booting
+    headers={"api-subscription-key": SARVAM_API_KEY} if SARVAM_API_KEY else {},
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+    timeout=10.0,
+)
+
+@app.on_event("startup")
+async def log_loop():
+    log.info(f"Event loop: {type(asyncio.get_running_loop()).__name__}")
+
+@app.on_event("shutdown")
+async def close_client():
+    await CLIENT.aclose()
+
 # ================= SCRIPT =================
 PITCH = (
     "Hi, my name is Neeraja from Rupeek. "
@@ -49,57 +93,365 @@ FAQ_MAP = {
     "documents": "No documents or income proof are required. It is fully digital.",
 }
 
+STEPS_DONE = "Great! Whenever you’re ready, just open the Rupeek app and check your pre approved loan limit."
+GOODBYE = "No problem. Thank you for your time."
+REPEAT = "Sorry, I didn’t catch that. Could you please repeat?"
+
+# Every line the bot can say; their audio is synthesized once and cached
+PROMPTS = [PITCH, *STEPS, *FAQ_MAP.values(), STEPS_DONE, GOODBYE, REPEAT]
+
+# Split replies after sentence punctuation for per-sentence TTS
+SENTENCE_RE = re.compile(r"(?<=[.?!])\s+")
+
+# All FAQ keys in one alternation so a single scan finds any of them
+FAQ_RE = re.compile("|".join(map(re.escape, FAQ_MAP)))
+
+# Whole words only, so "know" or "nothing" don't read as a "no". Only an
+# explicit yes/guide outranks a refusal; sure/ok/okay are weaker, and
+# "not sure" / "not ok" count as refusals
+INTENT_RE = re.compile(
+    r"\b(?:(?P<pos>yes|guide)"
+    r"|(?P<neg>not (?:sure|okay|ok)|no|nope|not)"
+    r"|(?P<ok>sure|okay|ok))\b"
+)
+
 # ================= TTS =================
-def tts(text: str) -> bytes:
-    r = requests.post(
-        "https://api.sarvam.ai/text-to-speech",
-        headers={
-            "api-subscription-key": SARVAM_API_KEY,
-            "Content-Type": "application/json",
-        },
+WAV_CHUNK = struct.Struct("<4sI")
+
+# Outbound media frames only differ in the payload, and base64 never needs
+# JSON escaping, so splice it into a pre-serialized frame
+MEDIA_PREFIX = b'{"event":"media","media":{"payload":"'
+MEDIA_SUFFIX = b'"}}'
+
+# Inbound fast path: Exotel media events lead with the event name
+MEDIA_EVENT = '{"event":"media"'
+PAYLOAD_RE = re.compile(r'"payload":\s*"([A-Za-z0-9+/=]*)"')
+
+def wav_to_pcm(wav: bytes) -> bytes:
+    # Sarvam returns a WAV file; Exotel wants the bare PCM samples
+    if wav[:4] != b"RIFF":
+        return wav
+    pos = 12
+    while pos + 8 <= len(wav):
+        chunk_id, size = WAV_CHUNK.unpack_from(wav, pos)
+        pos += 8
+        if chunk_id == b"data":
+            return wav[pos:pos + size]
+        pos += size + (size & 1)
+    return wav
+
+async def synthesize(text: str) -> bytes:
+    r = await CLIENT.post(
+        "/text-to-speech",
         json={
             "text": text,
-            "target_language_code": "en-IN",
+            "target_language_code": TTS_LANGUAGE,
             "speech_sample_rate": "16000",
         },
-        timeout=10,
     )
-    return base64.b64decode(r.json()["audios"][0])
+    return wav_to_pcm(binascii.a2b_base64(r.json()["audios"][0]))
 
-async def speak(ws: WebSocket, text: str, session: dict):
+# The script is a closed set of lines, so cache their audio in memory and
+# on disk; only the first call after a fresh deploy pays for synthesis
+TTS_CACHE: dict[str, bytes] = {}
+
+def tts_cache_path(text: str) -> Path:
+    key = f"{TTS_LANGUAGE}|{SAMPLE_RATE}|{text}".encode()
+    return TTS_CACHE_DIR / f"{hashlib.sha1(key).hexdigest()}.pcm"
+
+# Lines currently being fetched; concurrent calls asking for the same one
+# share a single Sarvam request
+TTS_INFLIGHT: dict[str, asyncio.Task] = {}
+
+# The disk cache is only a convenience: any disk error is logged and the
+# clip is still served (and kept in TTS_CACHE) for this process
+def read_cached_tts(path: Path) -> bytes | None:
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        log.warning(f"⚠️ TTS cache read failed for {path}: {e}")
+        return None
+
+def write_cached_tts(path: Path, pcm: bytes):
+    # Write to a temp file and rename it into place, so a crash or a second
+    # worker can never leave a truncated clip behind under the real name
+    try:
+        TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+    except OSError as e:
+        log.warning(f"⚠️ TTS cache write failed for {path}: {e}")
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pcm)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f"⚠️ TTS cache write failed for {path}: {e}")
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+async def fetch_tts(text: str) -> bytes:
+    path = tts_cache_path(text)
+    pcm = await asyncio.to_thread(read_cached_tts, path)
+    if pcm is None:
+        pcm = await synthesize(text)
+        await asyncio.to_thread(write_cached_tts, path, pcm)
+    TTS_CACHE[text] = pcm
+    return pcm
+
+async def tts(text: str) -> bytes:
+    pcm = TTS_CACHE.get(text)
+    if pcm is not None:
+        return pcm
+
+    task = TTS_INFLIGHT.get(text)
+    if task is None:
+        task = asyncio.create_task(fetch_tts(text))
+        TTS_INFLIGHT[text] = task
+        task.add_done_callback(lambda _: TTS_INFLIGHT.pop(text, None))
+    # Shielded so one caller hanging up doesn't cancel it for the others
+    return await asyncio.shield(task)
+
+async def warm_tts_cache():
+    sentences = {s for text in PROMPTS for s in SENTENCE_RE.split(text) if s}
+    results = await asyncio.gather(*map(tts, sentences), return_exceptions=True)
+    failed = sum(isinstance(r, Exception) for r in results)
+    log.info(f"🔊 TTS cache warmed: {len(sentences) - failed}/{len(sentences)} sentences")
+
+@app.on_event("startup")
+async def start_tts_warmup():
+    app.state.tts_warmup = asyncio.create_task(warm_tts_cache())
+
+async def tts_stream(text: str):
+    # Sarvam only returns whole clips, so synthesize every sentence at once
+    # and yield them in order; playback starts after the first one lands
+    tasks = [asyncio.create_task(tts(s)) for s in SENTENCE_RE.split(text) if s]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def speak(ws: WebSocket, text: str, session: dict) -> asyncio.Event:
+    # Queues the utterance for the call's writer task; the returned event
+    # is set once the last frame has gone out
     log.info(f"BOT → {text}")
     session["bot_speaking"] = True
-    pcm = await asyncio.to_thread(tts, text)
+    session["queued"] += 1
+
+    enc, put = binascii.b2a_base64, session["out_q"].put
+
+    def frame(chunk) -> str:
+        return (MEDIA_PREFIX + enc(chunk, newline=False) + MEDIA_SUFFIX).decode()
+
+    # Carry the tail of each sentence over so every frame but the last
+    # stays MEDIA_CHUNK_SIZE long
+    tail = b""
+    async for pcm in tts_stream(text):
+        pcm = tail + pcm
+        end = len(pcm) - len(pcm) % MEDIA_CHUNK_SIZE
+        # Slice through a memoryview so each chunk isn't copied before encoding
+        mv = memoryview(pcm)
+        frames = [frame(mv[i:i+MEDIA_CHUNK_SIZE]) for i in range(0, end, MEDIA_CHUNK_SIZE)]
+        for f in frames:
+            await put(f)
+        tail = pcm[end:]
+    if tail:
+        # Pad the last frame with silence up to a size Exotel accepts
+        size = max(MIN_CHUNK_SIZE, -(-len(tail) // CHUNK_ALIGN) * CHUNK_ALIGN)
+        await put(frame(tail.ljust(size, b"\0")))
 
-    for i in range(0, len(pcm), MIN_CHUNK_SIZE):
-        await ws.send_text(json.dumps({
-            "event": "media",
-            "media": {"payload": base64.b64encode(pcm[i:i+MIN_CHUNK_SIZE]).decode()}
-        }))
+    done = asyncio.Event()
+    await put(done)
+    return done
 
-    await asyncio.sleep(POST_TTS_DELAY)
-    session["bot_speaking"] = False
+async def writer(ws: WebSocket, session: dict):
+    out_q = session["out_q"]
+    while True:
+        frame = await out_q.get()
+        if isinstance(frame, asyncio.Event):
+            await asyncio.sleep(POST_TTS_DELAY)
+            session["queued"] -= 1
+            if not session["queued"]:
+                session["bot_speaking"] = False
+            frame.set()
+            continue
+        await ws.send_text(frame)
+
+# ================= AUDIO =================
+def downsample(pcm: bytes) -> bytes:
+    # 2:1 decimation; averaging each sample pair doubles as a cheap low-pass
+    arr = np.frombuffer(memoryview(pcm)[:len(pcm) // 4 * 4], dtype=np.int16)
+    return ((arr[0::2].astype(np.int32) + arr[1::2]) >> 1).astype(np.int16).tobytes()
 
 # ================= INTENT =================
 def handle_intent(text: str, session: dict) -> str:
     t = text.lower()
 
-    for k in FAQ_MAP:
-        if k in t:
-            return FAQ_MAP[k]
+    m = FAQ_RE.search(t)
+    if m:
+        return FAQ_MAP[m.group(0)]
+
+    # As in the original flow, yes/guide anywhere wins ("no, guide me"),
+    # then any refusal ("no, it's okay"), then a bare sure/ok
+    intents = {m.lastgroup for m in INTENT_RE.finditer(t)}
+    if "pos" in intents:
+        intent = "pos"
+    elif "neg" in intents:
+        intent = "neg"
+    elif "ok" in intents:
+        intent = "pos"
+    else:
+        intent = None
 
-    if "guide" in t or "yes" in t:
+    if intent == "pos":
         step = session["step"]
         if step < len(STEPS):
             session["step"] += 1
             return STEPS[step]
-        return "Great! Whenever you’re ready, just open the Rupeek app and check your pre approved loan limit."
+        return STEPS_DONE
 
-    if "no" in t:
+    if intent == "neg":
         session["end"] = True
-        return "No problem. Thank you for your time."
+        return GOODBYE
+
+    return REPEAT
+
+# ================= DEEPGRAM =================
+DEEPGRAM_URL = (
+    "wss://api.deepgram.com/v1/listen"
+    "?encoding=linear16"
+    f"&sample_rate={STT_SAMPLE_RATE}"
+    "&language=en-IN"
+    "&punctuate=true"
+    "&endpointing=300"
+)
+
+async def dg_connect():
+    dg_ws = await websockets.connect(
+        DEEPGRAM_URL,
+        extra_headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"}
+    )
+    dg_ws.opened_at = asyncio.get_running_loop().time()
+    return dg_ws
+
+class DeepgramPool:
+    # Keeps a few Deepgram sockets open ahead of time so a new call
+    # doesn't wait on the TLS + auth handshake before the pitch. size is
+    # the idle target; a finished call's socket goes back in whenever
+    # the idle set is short of it
+    def __init__(self, size: int):
+        self.size = size
+        self.idle = deque()
+        self.pending = set()
+        self.closing = set()
+        self.keepalive_task = None
+
+    async def start(self):
+        for _ in range(self.size):
+            self._refill()
+        self.keepalive_task = asyncio.create_task(self._keepalive())
+
+    async def stop(self):
+        if self.keepalive_task:
+            self.keepalive_task.cancel()
+        for task in self.pending:
+            task.cancel()
+        while self.idle:
+            await self.idle.popleft().close()
+
+    def _refill(self):
+        if len(self.idle) + len(self.pending) >= self.size:
+            return
+        task = asyncio.create_task(self._open())
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _open(self):
+        try:
+            self.idle.append(await dg_connect())
+        except Exception as e:
+            log.warning(f"⚠️ Deepgram prewarm failed: {e}")
+
+    def _expired(self, dg_ws) -> bool:
+        return asyncio.get_running_loop().time() - dg_ws.opened_at >= DG_MAX_SOCKET_AGE
 
-    return "Sorry, I didn’t catch that. Could you please repeat?"
+    def _retire(self, dg_ws):
+        # Close in the background; the close handshake can take a while
+        task = asyncio.create_task(dg_ws.close())
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def _keepalive(self):
+        # Deepgram drops sockets that see no audio for ~10s
+        while True:
+            await asyncio.sleep(DG_KEEPALIVE_INTERVAL)
+            try:
+                for dg_ws in list(self.idle):
+                    # acquire() may have taken it while an earlier send awaited
+                    if dg_ws not in self.idle:
+                        continue
+                    if self._expired(dg_ws):
+                        self.idle.remove(dg_ws)
+                        self._retire(dg_ws)
+                        continue
+                    try:
+                        await dg_ws.send('{"type": "KeepAlive"}')
+                    except websockets.ConnectionClosed:
+                        if dg_ws in self.idle:
+                            self.idle.remove(dg_ws)
+                self._refill()
+            except Exception as e:
+                # A dead keepalive loop would let Deepgram drop every idle socket
+                log.error(f"❌ Deepgram keepalive failed: {e!r}")
+
+    async def acquire(self):
+        while self.idle:
+            dg_ws = self.idle.popleft()
+            if dg_ws.open and not self._expired(dg_ws):
+                break
+            self._retire(dg_ws)
+        else:
+            dg_ws = await dg_connect()
+        self._refill()
+        return dg_ws
+
+    async def release(self, dg_ws):
+        # A socket goes back in the pool only once Deepgram has flushed the
+        # last call's audio, so no stale transcript reaches the next caller.
+        # The idle check is repeated after the flush since a refill may have
+        # landed meanwhile
+        if dg_ws.open and not self._expired(dg_ws) and len(self.idle) < self.size:
+            try:
+                if (await asyncio.wait_for(self._finalize(dg_ws), DG_FINALIZE_TIMEOUT)
+                        and len(self.idle) < self.size):
+                    self.idle.append(dg_ws)
+                    return
+            except (asyncio.TimeoutError, websockets.ConnectionClosed):
+                pass
+        await dg_ws.close()
+
+    async def _finalize(self, dg_ws) -> bool:
+        await dg_ws.send('{"type": "Finalize"}')
+        async for msg in dg_ws:
+            if orjson.loads(msg).get("from_finalize"):
+                return True
+        return False
+
+dg_pool = DeepgramPool(DG_POOL_SIZE)
+
+@app.on_event("startup")
+async def start_dg_pool():
+    await dg_pool.start()
+
+@app.on_event("shutdown")
+async def stop_dg_pool():
+    await dg_pool.stop()
 
 # ================= WS =================
 @app.websocket("/ws")
@@ -112,40 +464,71 @@ async def ws_handler(ws: WebSocket):
         "bot_speaking": False,
         "step": 0,
         "end": False,
+        "out_q": asyncio.Queue(maxsize=OUT_QUEUE_SIZE),
+        "queued": 0,
     }
+    in_q = asyncio.Queue(maxsize=IN_QUEUE_SIZE)
 
-    deepgram_url = (
-        "wss://api.deepgram.com/v1/listen"
-        "?encoding=linear16"
-        "&sample_rate=16000"
-        "&language=en-IN"
-        "&punctuate=true"
-        "&endpointing=300"
-    )
+    dg_ws = await dg_pool.acquire()
+    writer_task = asyncio.create_task(writer(ws, session))
 
-    async with websockets.connect(
-        deepgram_url,
-        extra_headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"}
-    ) as dg_ws:
-
-        async def dg_receiver():
-            async for msg in dg_ws:
-                data = json.loads(msg)
-                if data.get("is_final"):
-                    transcript = data["channel"]["alternatives"][0]["transcript"].strip()
-                    if transcript:
-                        log.info(f"USER → {transcript}")
-                        reply = handle_intent(transcript, session)
-                        await speak(ws, reply, session)
-                        if session["end"]:
-                            await ws.close()
-
-        dg_task = asyncio.create_task(dg_receiver())
+    async def dg_receiver():
+        async for msg in dg_ws:
+            data = orjson.loads(msg)
+            if data.get("is_final"):
+                transcript = data["channel"]["alternatives"][0]["transcript"].strip()
+                if transcript:
+                    log.info(f"USER → {transcript}")
+                    reply = handle_intent(transcript, session)
+                    done = await speak(ws, reply, session)
+                    if session["end"]:
+                        await done.wait()
+                        await ws.close()
+                        return
+
+    async def dg_sender():
+        # Decoding and the Deepgram write happen here so the receive loop
+        # below only ever parses and enqueues
+        last_payload, pcm = None, b""
+        while True:
+            payloads = [await in_q.get()]
+            # Whatever piled up while the last send was in flight goes out
+            # as one message; payloads are decoded one by one because joined
+            # base64 stops at the first padding
+            while not in_q.empty():
+                payloads.append(in_q.get_nowait())
+            chunks = []
+            for payload in payloads:
+                # Idle lines repeat the exact same silence frame; decode it once
+                if payload != last_payload:
+                    pcm = binascii.a2b_base64(payload)
+                    if STT_DOWNSAMPLE:
+                        pcm = downsample(pcm)
+                    last_payload = payload
+                chunks.append(pcm)
+            await dg_ws.send(chunks[0] if len(chunks) == 1 else b"".join(chunks))
 
+    def forward(payload: str):
+        if in_q.full():
+            # Deepgram is behind; drop the oldest audio, not the socket
+            in_q.get_nowait()
+        in_q.put_nowait(payload)
+
+    async def exotel_receiver():
         try:
             while True:
                 msg = await ws.receive_text()
-                data = json.loads(msg)
+                # Caller audio is dropped during playback anyway; skip parsing it
+                if session["bot_speaking"] and '"media"' in msg:
+                    continue
+                # Media frames are nearly all the traffic and always the same
+                # shape, so lift the payload out without a full JSON parse
+                if msg.startswith(MEDIA_EVENT):
+                    m = PAYLOAD_RE.search(msg)
+                    if m:
+                        forward(m.group(1))
+                        continue
+                data = orjson.loads(msg)
 
                 if data.get("event") == "start" and not session["started"]:
                     log.info("📡 Exotel start event received")
@@ -154,14 +537,45 @@ async def ws_handler(ws: WebSocket):
                     continue
 
                 if data.get("event") == "media" and not session["bot_speaking"]:
-                    pcm = base64.b64decode(data["media"]["payload"])
-                    await dg_ws.send(pcm)
+                    forward(data["media"]["payload"])
 
         except WebSocketDisconnect:
             log.info("🔌 WebSocket disconnected")
 
-        finally:
-            dg_task.cancel()
+    tasks = [
+        asyncio.create_task(exotel_receiver()),
+        asyncio.create_task(dg_receiver()),
+        asyncio.create_task(dg_sender()),
+        writer_task,
+    ]
+
+    try:
+        # The call is over as soon as any side stops: the caller hung up,
+        # the bot said goodbye, or a Deepgram/Exotel socket failed
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Let every task unwind before dg_ws is handed back, and surface
+        # anything that failed rather than was cancelled
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                log.error(f"❌ Call task failed: {result!r}")
+        # Hang up rather than leave the caller on a bot that can't hear them
+        if (ws.client_state == WebSocketState.CONNECTED
+                and ws.application_state == WebSocketState.CONNECTED):
+            await ws.close()
+        await dg_pool.release(dg_ws)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        access_log=False,
+    )